@@ -126,29 +126,90 @@
 # % description: Filter change detection product using a mode filter of size window_size
 # %end
 
+# %flag
+# % key: n
+# % description: Do not cache the information gain raster between runs
+# %end
+
 import atexit
+import hashlib
 import os
+import shutil
+import subprocess
 import grass.script as grass
+from grass.pygrass.modules import Module, ParallelModuleQueue
 
 # initialize global vars
 rm_rasters = []
+tmp_mapset = None
+old_mapset = None
+old_region = None
+
+# minimum number of region cells for which tiled r.mapcalc pays off;
+# below it the tiling overhead outweighs the gains
+TILING_CELLS_THRESHOLD = 1e9
+
+# number of parallel processes used by r.mapcalc and the module queues;
+# overridable so users can throttle the module on shared machines
+NPROCS = int(os.environ.get("GRASS_NPROCS", os.cpu_count() or 1))
+
+
+def run_mapcalc(expression):
+    """Run an r.mapcalc expression, tiled for very large regions."""
+    if grass.region()["cells"] >= TILING_CELLS_THRESHOLD and grass.find_program(
+        "r.mapcalc.tiled", "--help"
+    ):
+        grass.run_command(
+            "r.mapcalc.tiled",
+            expression=expression,
+            width=10000,
+            height=10000,
+            nprocs=NPROCS,
+            patch_backend="r.patch",
+            quiet=True,
+        )
+    else:
+        # grass.mapcalc hands the expression to r.mapcalc via its
+        # expression file, avoiding argv length limits and shell quoting
+        grass.mapcalc(expression, nprocs=NPROCS, quiet=True)
 
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
     kwargs = {
         "flags": "f",
         "quiet": True,
-        "stderr": nuldev
+        "stderr": subprocess.DEVNULL
     }
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
+    if tmp_mapset:
+        # switch back and drop the temporary mapset with all the
+        # intermediate rasters in it
+        gisenv = grass.gisenv()
+        if gisenv["MAPSET"] != old_mapset:
+            grass.run_command("g.mapset", mapset=old_mapset, quiet=True)
+        shutil.rmtree(
+            os.path.join(
+                gisenv["GISDBASE"], gisenv["LOCATION_NAME"], tmp_mapset
+            ),
+            ignore_errors=True,
+        )
+    if old_region:
+        grass.run_command("g.remove", type="region", name=old_region, **kwargs)
+    # remove all temporary rasters with one g.remove call instead of
+    # spawning one process per raster; a single g.list scan replaces the
+    # per-raster find_file probes
+    existing = set(
+        grass.read_command("g.list", type="raster", mapset=".").splitlines()
+    )
+    to_remove = [rmrast for rmrast in rm_rasters if rmrast in existing]
+    if to_remove:
+        grass.run_command(
+            "g.remove", type="raster", name=",".join(to_remove), **kwargs
+        )
 
 
 def main():
 
-    global rm_rasters
+    global rm_rasters, tmp_mapset, old_mapset, old_region
     # parameters
     input = options["input"].split(",")
     if len(input) != 2:
@@ -166,6 +227,45 @@ def main():
     output_bu = options["output_bu"]
     output_bare = options["output_bare"]
 
+    output_list = [output_forest, output_lowveg, output_water, output_bu,
+                   output_bare, output_agr]
+    values_list = ["10", "20", "30", "40", "50", "60"]
+    output_used = []
+    values_used = []
+    for idx, item in enumerate(output_list):
+        if len(item) > 0:
+            output_used.append(item)
+            values_used.append(values_list[idx])
+
+    # skip the expensive r.change.stats/r.change.info runs entirely if no
+    # output was requested
+    if not options["output_cd"] and len(output_used) == 0:
+        grass.warning(_("No output maps requested, nothing to compute"))
+        return
+
+    # keep the intermediate rasters out of the user's mapset: work in a
+    # temporary mapset of the current location (which can live on tmpfs)
+    # and copy only the requested outputs back
+    old_mapset = grass.gisenv()["MAPSET"]
+    old_region = "tmp_region_%s" % os.getpid()
+    grass.run_command("g.region", save=old_region, quiet=True)
+    tmp_mapset = "tmp_mapset_%s" % os.getpid()
+    grass.run_command("g.mapset", mapset=tmp_mapset, flags="c", quiet=True)
+    grass.run_command(
+        "g.mapsets", mapset=old_mapset, operation="add", quiet=True
+    )
+    grass.run_command(
+        "g.region", region="%s@%s" % (old_region, old_mapset), quiet=True
+    )
+    # a MASK raster only applies in the current mapset, so bring an
+    # active user MASK along to keep it honored by all computations
+    if grass.find_file(name="MASK", element="raster", mapset=old_mapset)[
+        "file"
+    ]:
+        grass.run_command(
+            "g.copy", raster="MASK@%s,MASK" % old_mapset, quiet=True
+        )
+
     if not grass.find_program("r.change.stats", "--help"):
         grass.fatal(_("The 'r.change.stats' module was not found, install it first:") +
                     "\n" +
@@ -184,55 +284,122 @@ def main():
     if flags["f"]:
         cd_params["window_size"] = options["mode_winsize"]
         cd_params["flags"] += "f"
-    grass.message(_("Calculating change detection..."))
-    grass.run_command("r.change.stats", **cd_params)
-    output_list = [output_forest, output_lowveg, output_water, output_bu,
-                   output_bare, output_agr]
-    values_list = ["10", "20", "30", "40", "50", "60"]
-    output_used = []
-    values_used = []
-    for idx, item in enumerate(output_list):
-        if len(item) > 0:
-            output_used.append(item)
-            values_used.append(values_list[idx])
-
-    grass.message(_("Calculating Information Gain..."))
-    gainmap = "gainmap_%s" % os.getpid()
-    rm_rasters.append(gainmap)
-    steps = int(options["gain_winsize"])/2
-    grass.run_command("r.change.info", input=input, method="gain1",
-                      size=options["gain_winsize"], step=steps,
-                      output=gainmap, quiet=True)
+    # the information gain map depends only on the inputs, the window
+    # size and the region, so reuse it across runs under a name derived
+    # from those (unless the user opts out); users iterating over
+    # minsize or gain_thresh then skip the r.change.info run entirely
+    gainmap_cached = False
+    if flags["n"]:
+        gainmap = "gainmap_%s" % os.getpid()
+        rm_rasters.append(gainmap)
+    else:
+        key = hashlib.sha1(
+            "{}|{}|{}|{}".format(
+                input[0],
+                input[1],
+                options["gain_winsize"],
+                grass.read_command("g.region", flags="pg"),
+            ).encode()
+        ).hexdigest()[:12]
+        gainmap = "incora_gain_cache_%s" % key
+        gain_file = grass.find_file(name=gainmap, element="raster")["file"]
+        if gain_file:
+            # only trust the cache if it is newer than both inputs
+            gainmap_cached = all(
+                os.path.getmtime(
+                    grass.find_file(name=inp, element="raster")["file"]
+                )
+                <= os.path.getmtime(gain_file)
+                for inp in input
+            )
+    steps = int(options["gain_winsize"]) // 2
+    # r.change.stats and r.change.info are independent of each other, so
+    # let both run concurrently
+    grass.message(_("Calculating change detection and Information Gain..."))
+    queue = ParallelModuleQueue(nprocs=2)
+    queue.put(Module("r.change.stats", run_=False, **cd_params))
+    if not gainmap_cached:
+        queue.put(Module("r.change.info", input=input, method="gain1",
+                         size=options["gain_winsize"], step=steps,
+                         output=gainmap, quiet=True, run_=False))
+    queue.wait()
+    # correct the outrast_cd raster with the information gain; this is
+    # needed for the output_cd map itself as well as for the class
+    # outputs, so it must not depend on class outputs being requested
+    eq = f"{outrast_cd} = if({gainmap}>{options['gain_thresh']},{cd_temprast},0)"
+    run_mapcalc(eq)
     if len(output_used) > 0:
-        tempraster_1 = "%s_tmp1_%s" % (item, os.getpid())
+        tempraster_1 = "change_tmp1_%s" % os.getpid()
         rm_rasters.append(tempraster_1)
-        # correct the outrast_cd raster with the information gain
-        eq = f"{outrast_cd} = if({gainmap}>{options['gain_thresh']},{cd_temprast},0)"
-        grass.run_command("r.mapcalc", expression=eq, quiet=True)
         # this binary raster contains where changes occured
-        expression_1 = "%s = if(%s > %s && %s != 0, 1, null())" % (
+        expression_1 = "%s = if(%s > %s &&& %s != 0, 1, null())" % (
                        tempraster_1, gainmap, options["gain_thresh"],
                        outrast_cd)
-        grass.run_command("r.mapcalc", expression=expression_1, quiet=True)
-    for idx, item in enumerate(output_used):
-        grass.message(_("Calculating change raster %s..." % item))
-        tempraster_2 = "%s_tmp2_%s" % (item, os.getpid())
-        rm_rasters.append(tempraster_2)
-        # this raster contains where changes occured and one of the input
-        # rasters contains the respective class (1 = map1, 2 = map2)
-        expression_2 = f"{tempraster_2} = if({tempraster_1} == 1 && " \
-            f"{input[0]} == {values_used[idx]},1, " \
-            f"if({tempraster_1} == 1 && {input[1]} == {values_used[idx]}," \
-            f"2,null()))"
-        grass.run_command("r.mapcalc", expression=expression_2, quiet=True)
-        # omit areas smaller < threshold
+        run_mapcalc(expression_1)
+        # build all per-class intermediate rasters in one multi-output
+        # r.mapcalc pass, so tempraster_1 and the two input rasters are
+        # read only once instead of once per class; the rasters contain
+        # where changes occured and one of the input rasters contains the
+        # respective class (1 = map1, 2 = map2)
+        grass.message(_("Calculating change rasters..."))
+        temprasters_2 = []
+        # bind the change test and the two input rasters once via eval();
+        # the class codes are multiples of 10, so encode each input cell
+        # as a one-bit class membership mask once and test the classes
+        # with a bitwise AND, which factors the division out of all six
+        # class expressions. The expressions only differ in output name
+        # and class bit, so fill a prebuilt template instead of
+        # assembling f-strings in the loop
+        template = (
+            "{out} = if(change &&& (bits0 & {bit}),1,"
+            "if(change &&& (bits1 & {bit}),2,null()))"
+        )
+        expressions_2 = [
+            "eval(change = %s == 1, bits0 = 1 << (%s / 10), "
+            "bits1 = 1 << (%s / 10))"
+            % (tempraster_1, input[0], input[1])
+        ]
+        for value, item in zip(values_used, output_used):
+            tempraster_2 = "%s_tmp2_%s" % (item, os.getpid())
+            rm_rasters.append(tempraster_2)
+            temprasters_2.append(tempraster_2)
+            expressions_2.append(template.format(
+                out=tempraster_2, bit=1 << (int(value) // 10)))
+        grass.mapcalc("; ".join(expressions_2), nprocs=1, quiet=True)
+        # omit areas smaller < threshold; the per-class calls are
+        # independent of each other, so run them in parallel
+        queue = ParallelModuleQueue(nprocs=min(NPROCS, len(output_used)))
+        for tempraster_2, item in zip(temprasters_2, output_used):
+            queue.put(Module(
+                "r.reclass.area",
+                input=tempraster_2,
+                output=item,
+                value=options["minsize"],
+                mode="greater",
+                method="reclass",
+                quiet=True,
+                run_=False,
+            ))
+        queue.wait()
+    # copy the requested outputs into the user's mapset; the temporary
+    # mapset is removed in cleanup
+    grass.run_command("g.mapset", mapset=old_mapset, quiet=True)
+    if options["output_cd"]:
+        grass.run_command(
+            "g.copy",
+            raster="%s@%s,%s" % (outrast_cd, tmp_mapset, outrast_cd),
+            quiet=True,
+        )
+    # the class outputs are virtual reclass maps whose base rasters live
+    # in the temporary mapset, so materialize them instead of copying
+    for item in output_used:
+        run_mapcalc("%s = %s@%s" % (item, item, tmp_mapset))
+    if not flags["n"] and not gainmap_cached:
+        # persist the freshly computed gain map for the next run
         grass.run_command(
-            "r.reclass.area",
-            input=tempraster_2,
-            output=item,
-            value=options["minsize"],
-            mode="greater",
-            method="reclass",
+            "g.copy",
+            raster="%s@%s,%s" % (gainmap, tmp_mapset, gainmap),
+            overwrite=True,
             quiet=True,
         )
     grass.message(_("Generated output maps:"))
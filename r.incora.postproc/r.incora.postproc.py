@@ -60,23 +60,77 @@
 
 import atexit
 import os
+import shutil
+import subprocess
 import grass.script as grass
 
 # initialize global vars
 rm_rasters = []
+tmp_mapset = None
+old_mapset = None
+old_region = None
+
+# minimum number of region cells for which tiled r.mapcalc pays off;
+# below it the tiling overhead outweighs the gains
+TILING_CELLS_THRESHOLD = 1e9
+
+# number of parallel processes used by r.mapcalc and the module queues;
+# overridable so users can throttle the module on shared machines
+NPROCS = int(os.environ.get("GRASS_NPROCS", os.cpu_count() or 1))
+
+
+def run_mapcalc(expression):
+    """Run an r.mapcalc expression, tiled for very large regions."""
+    if grass.region()["cells"] >= TILING_CELLS_THRESHOLD and grass.find_program(
+        "r.mapcalc.tiled", "--help"
+    ):
+        grass.run_command(
+            "r.mapcalc.tiled",
+            expression=expression,
+            width=10000,
+            height=10000,
+            nprocs=NPROCS,
+            patch_backend="r.patch",
+            quiet=True,
+        )
+    else:
+        # grass.mapcalc hands the expression to r.mapcalc via its
+        # expression file, avoiding argv length limits and shell quoting
+        grass.mapcalc(expression, nprocs=NPROCS, quiet=True)
 
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
+    kwargs = {"flags": "f", "quiet": True, "stderr": subprocess.DEVNULL}
+    if tmp_mapset:
+        # switch back and drop the temporary mapset with all the
+        # intermediate rasters in it
+        gisenv = grass.gisenv()
+        if gisenv["MAPSET"] != old_mapset:
+            grass.run_command("g.mapset", mapset=old_mapset, quiet=True)
+        shutil.rmtree(
+            os.path.join(
+                gisenv["GISDBASE"], gisenv["LOCATION_NAME"], tmp_mapset
+            ),
+            ignore_errors=True,
+        )
+    if old_region:
+        grass.run_command("g.remove", type="region", name=old_region, **kwargs)
+    # remove all temporary rasters with one g.remove call instead of
+    # spawning one process per raster; a single g.list scan replaces the
+    # per-raster find_file probes
+    existing = set(
+        grass.read_command("g.list", type="raster", mapset=".").splitlines()
+    )
+    to_remove = [rmrast for rmrast in rm_rasters if rmrast in existing]
+    if to_remove:
+        grass.run_command(
+            "g.remove", type="raster", name=",".join(to_remove), **kwargs
+        )
 
 
 def main():
 
-    global rm_rasters
+    global rm_rasters, tmp_mapset, old_mapset, old_region
 
     raster_7classes = options["classification"]
     coastline = options["coastline"]
@@ -85,27 +139,38 @@ def main():
     roads = options["roads"]
     output = options["output"]
 
-    # rebrand high altitude water pixels to mixed class to remove them
-    # (mountain shadow)
-    water_elevation = "water_elevation_%s" % os.getpid()
-    rm_rasters.append(water_elevation)
+    # keep the intermediate rasters out of the user's mapset: work in a
+    # temporary mapset of the current location (which can live on tmpfs)
+    # and copy only the output back
+    old_mapset = grass.gisenv()["MAPSET"]
+    old_region = "tmp_region_%s" % os.getpid()
+    grass.run_command("g.region", save=old_region, quiet=True)
+    tmp_mapset = "tmp_mapset_%s" % os.getpid()
+    grass.run_command("g.mapset", mapset=tmp_mapset, flags="c", quiet=True)
     grass.run_command(
-        "r.mapcalc",
-        expression="%s = if(%s>1000 && %s==30,70,%s)"
-        % (water_elevation, dem, raster_7classes, raster_7classes),
-        quiet=True,
+        "g.mapsets", mapset=old_mapset, operation="add", quiet=True
     )
+    grass.run_command(
+        "g.region", region="%s@%s" % (old_region, old_mapset), quiet=True
+    )
+    # a MASK raster only applies in the current mapset, so bring an
+    # active user MASK along to keep it honored by all computations
+    if grass.find_file(name="MASK", element="raster", mapset=old_mapset)[
+        "file"
+    ]:
+        grass.run_command(
+            "g.copy", raster="MASK@%s,MASK" % old_mapset, quiet=True
+        )
 
+    # remove the mixed class and high altitude water pixels (mountain
+    # shadow) so they get filled by r.grow.distance; fused into one
+    # expression to avoid an intermediate raster pass
     postproc_raster2 = "postproc_raster2_%s" % os.getpid()
     rm_rasters.append(postproc_raster2)
-    # grass.run_command('r.mapcalc', expression="%s = if(%s==70,null(),%s)" % (
-    #                   postproc_raster2, postproc_raster1, postproc_raster1),
-    #                   quiet=True)
-    grass.run_command(
-        "r.mapcalc",
-        expression="%s = if(%s==70,null(),%s)"
-        % (postproc_raster2, water_elevation, water_elevation),
-        quiet=True,
+    run_mapcalc(
+        "%s = if(%s==70 ||| (%s>1000 &&& %s==30),null(),%s)"
+        % (postproc_raster2, raster_7classes, dem, raster_7classes,
+           raster_7classes)
     )
     grow_raster = "grow_distance_raster_%s" % os.getpid()
     rm_rasters.append(grow_raster)
@@ -114,46 +179,48 @@ def main():
         "r.grow.distance", input=postproc_raster2, value=grow_raster, quiet=True
     )
 
-    rounded = "rounded_grow_distance_raster_%s" % os.getpid()
-    rm_rasters.append(rounded)
-
-    grass.run_command(
-        "r.mapcalc", expression="%s = round(%s)" % (rounded, grow_raster), quiet=True
-    )
-
-    # reclassify urban areas outside coastline to bare soil
-    coast_corrected = "coast_corrected_%s" % os.getpid()
-    rm_rasters.append(coast_corrected)
-
-    grass.run_command(
-        "r.mapcalc",
-        expression="%s = if(isnull(%s) &&& %s==40,50,%s)"
-        % (coast_corrected, coastline, rounded, rounded),
-        quiet=True,
-    )
-
-    # reclassify urban areas > 1500m to bare soil and agriculture > 900 m to
-    # low vegetation
+    # reclassify urban areas outside coastline or > 1500m to bare soil
+    # and agriculture > 800 m to low vegetation, fused into a single
+    # nested expression so the raster is only read once; if the coastline
+    # raster is constant null, the isnull() test is true everywhere and
+    # the raster does not need to be read at all. The value output of
+    # r.grow.distance propagates the integer class codes exactly, so no
+    # rounding is needed for the equality tests; only the pass-through
+    # value is cast to keep the output CELL typed
     elevation_corrected = "elevation_corrected_%s" % os.getpid()
     rm_rasters.append(elevation_corrected)
-    el_expression = "%s = if(%s>1500 && %s==40,50,if(%s>800 && %s==60,20,%s))" % (
-        elevation_corrected,
-        dem,
-        coast_corrected,
-        dem,
-        coast_corrected,
-        coast_corrected,
+    if grass.raster_info(coastline)["min"] is None:
+        # constant-null coastline: every urban pixel lies outside it
+        urban_case = "50"
+    else:
+        urban_case = "if(isnull(%s),50,if(%s>1500,50,40))" % (coastline, dem)
+    # only the urban (40) and agriculture (60) classes need corrections;
+    # all other classes pass through at the first test, so the vast
+    # majority of pixels is done after a single comparison
+    el_expression = (
+        "%s = if(%s<40 ||| %s==50,int(%s),"
+        "if(%s==40,%s,"
+        "if(%s>800,20,60)))"
+        % (
+            elevation_corrected,
+            grow_raster,
+            grow_raster,
+            grow_raster,
+            grow_raster,
+            urban_case,
+            dem,
+        )
     )
-    grass.run_command("r.mapcalc", expression=el_expression, quiet=True)
 
     # reclassifiy agriculture < 1.5 ha to low vegetation
-    # get agriculture areas only
+    # get agriculture areas only; emitted in the same r.mapcalc run as
+    # the corrected raster, so it falls out of the same pass instead of
+    # re-reading the corrected raster from disk
     agr_only = "agr_only_%s" % os.getpid()
     rm_rasters.append(agr_only)
-    grass.run_command(
-        "r.mapcalc",
-        expression="%s = if(%s==60,60,null())" % (agr_only, elevation_corrected),
-    )
+    agr_expression = "%s = if(%s==60,60,null())" % (agr_only, elevation_corrected)
+    grass.mapcalc("; ".join([el_expression, agr_expression]), nprocs=1,
+                  quiet=True)
 
     # get all areas smaller 1.5 ha
     small_areas = "areas_smaller_1_5_ha_%s" % os.getpid()
@@ -167,21 +234,32 @@ def main():
         quiet=True,
     )
 
-    # get corrected agriculture
-    agr_corrected = "agr_corrected_%s" % os.getpid()
-    rm_rasters.append(agr_corrected)
-    grass.run_command(
-        "r.mapcalc",
-        expression="%s = if(isnull(%s),%s,20)"
-        % (agr_corrected, small_areas, elevation_corrected),
-        quiet=True,
+    # reclassify small agriculture areas to low vegetation and remove
+    # builtup areas on water; fused so only the final output raster is
+    # materialized after small_areas
+    run_mapcalc(
+        (
+            "%s = if(not(isnull(%s)) && isnull(%s) && isnull(%s) &&& %s==40,"
+            "30,if(isnull(%s),%s,20))"
+        )
+        % (
+            output,
+            water,
+            roads,
+            small_areas,
+            elevation_corrected,
+            small_areas,
+            elevation_corrected,
+        )
     )
 
-    # remove builtup areas on water
+    # copy the result into the user's mapset; the temporary mapset is
+    # removed in cleanup
+    grass.run_command("g.mapset", mapset=old_mapset, quiet=True)
     grass.run_command(
-        "r.mapcalc",
-        expression="%s = if(not(isnull(%s)) && isnull(%s) && %s==40,30,%s)"
-        % (output, water, roads, agr_corrected, agr_corrected),
+        "g.copy",
+        raster="%s@%s,%s" % (output, tmp_mapset, output),
+        quiet=True,
     )
 
     grass.message(_("Generated output map <%s>" % output))
@@ -121,7 +121,11 @@
 
 import atexit
 import os
+import subprocess
+import numpy as np
 import grass.script as grass
+import grass.script.array as garray
+from grass.pygrass.modules import Module, ParallelModuleQueue
 
 # initialize global vars
 rm_rasters = []
@@ -130,28 +134,109 @@ rm_regions = []
 oldregion = None
 oldmask = None
 
+# minimum number of region cells for which tiled r.mapcalc pays off;
+# below it the tiling overhead outweighs the gains
+TILING_CELLS_THRESHOLD = 1e9
+
+# number of parallel processes used by r.mapcalc and the module queues;
+# more than 4 workers rarely pays off for the memory-bound expressions
+# here, but the value can be raised on machines with fast memory
+NPROCS = int(os.environ.get("GRASS_NPROCS", min(4, os.cpu_count() or 1)))
+
+
+def run_mapcalc(expression):
+    """Run an r.mapcalc expression, tiled for very large regions."""
+    if grass.region()["cells"] >= TILING_CELLS_THRESHOLD and grass.find_program(
+        "r.mapcalc.tiled", "--help"
+    ):
+        grass.run_command(
+            "r.mapcalc.tiled",
+            expression=expression,
+            width=10000,
+            height=10000,
+            nprocs=NPROCS,
+            patch_backend="r.patch",
+            quiet=True,
+        )
+    else:
+        # grass.mapcalc hands the expression to r.mapcalc via its
+        # expression file, avoiding argv length limits and shell quoting
+        grass.mapcalc(expression, nprocs=NPROCS, quiet=True)
+
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
+    kwargs = {"flags": "f", "quiet": True, "stderr": subprocess.DEVNULL}
     if oldmask:
         grass.run_command("r.mask", raster=oldmask)
         rm_rasters.append(oldmask)
     if oldregion:
         grass.run_command("g.region", region=oldregion)
         rm_rasters.append(oldregion)
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
-    for rmvect in rm_vectors:
-        if grass.find_file(name=rmvect, element="vector")["file"]:
-            grass.run_command("g.remove", type="vector", name=rmvect, **kwargs)
-    for rmr in rm_regions:
-        if rmr in [x for x in grass.parse_command("g.list", type="region")]:
-            grass.run_command("g.remove", type="region", name=rmr, **kwargs)
-
-
-def get_percentile(raster, percentile):
+    # one g.list scan per element type replaces the per-item find_file
+    # and g.list probes, and one g.remove per type the per-item removals
+    existing_rasters = set(
+        grass.read_command("g.list", type="raster", mapset=".").splitlines()
+    )
+    to_remove = [rmrast for rmrast in rm_rasters if rmrast in existing_rasters]
+    if to_remove:
+        grass.run_command(
+            "g.remove", type="raster", name=",".join(to_remove), **kwargs
+        )
+    existing_vectors = set(
+        grass.read_command("g.list", type="vector", mapset=".").splitlines()
+    )
+    to_remove = [rmvect for rmvect in rm_vectors if rmvect in existing_vectors]
+    if to_remove:
+        grass.run_command(
+            "g.remove", type="vector", name=",".join(to_remove), **kwargs
+        )
+    existing_regions = set(grass.parse_command("g.list", type="region"))
+    to_remove = [rmr for rmr in rm_regions if rmr in existing_regions]
+    if to_remove:
+        grass.run_command(
+            "g.remove", type="region", name=",".join(to_remove), **kwargs
+        )
+
+
+def category_test(raster, cats):
+    """Build an r.mapcalc test for membership in space-separated cats."""
+    return (
+        "("
+        + " ||| ".join("%s==%s" % (raster, cat) for cat in cats.split())
+        + ")"
+    )
+
+
+def filter_small_areas(raster, output, minsize_ha, class_value, region):
+    """Keep only connected areas of raster larger than minsize_ha hectares
+    and write them to output with class_value, like r.reclass.area
+    mode=greater, but with a single r.clump pass and the per-area size
+    statistics computed in NumPy instead of a second r.stats scan."""
+    clumps = "%s_clumps" % output
+    rm_rasters.append(clumps)
+    grass.run_command("r.clump", input=raster, output=clumps, quiet=True)
+    cell_area_ha = region["nsres"] * region["ewres"] / 10000.0
+    # clump ids start at 1, so nulls read as 0 cannot collide
+    clump_arr = garray.array(clumps, dtype=np.int32)
+    sizes = np.bincount(clump_arr.ravel())
+    keep = sizes * cell_area_ha > float(minsize_ha)
+    keep[0] = False
+    out_arr = garray.array(dtype=np.int32)
+    out_arr[...] = np.where(keep[clump_arr], int(class_value), 0)
+    out_arr.write(output, null=0, overwrite=True)
+
+
+# maximum number of region cells for which get_percentile reads the
+# raster into memory; above it r.quantile's streaming histogram is used
+QUANTILE_MAX_CELLS = 5e8
+
+
+def get_percentile(raster, percentile, region):
+    """Return the given percentile of raster, computed in memory with
+    NumPy when the region fits, via r.quantile otherwise."""
+    if region["cells"] <= QUANTILE_MAX_CELLS:
+        arr = garray.array(raster, null=np.nan, dtype=np.float32)
+        return float(np.quantile(arr[~np.isnan(arr)], percentile / 100.0))
     return float(
         list(
             (
@@ -178,6 +263,9 @@ def main():
     # save actuall region
     oldregion = "region_tmp_%s" % id
     grass.run_command("g.region", save=oldregion)
+    # the region settings are needed in several helpers; read them once
+    # instead of spawning g.region for every call
+    region = grass.region()
 
     red = options["red"]
     green = options["green"]
@@ -221,154 +309,166 @@ def main():
     # lc_builtup_class = "62"
     lc_agr_class = "73 75"
 
-    if not grass.find_program("r.sample.category", "--help"):
-        grass.fatal(
-            _("The 'r.sample.category' module was not found, install it first:")
-            + "\n"
-            + "g.extension r.sample.category"
+    # the NDVI/NDWI rasters are only ever compared against integer
+    # thresholds but typically arrive as FCELL/DCELL; round them once to
+    # CELL so every later pass over them moves half the bytes
+    quant_exprs = []
+    quantized = []
+    for in_rast in (NDVI_max, NDVI_min, NDVI_range, NDWI):
+        if grass.raster_info(in_rast)["datatype"] == "CELL":
+            quantized.append(in_rast)
+            continue
+        quant = "%s_int_%s" % (in_rast.split("@")[0], id)
+        rm_rasters.append(quant)
+        quant_exprs.append("%s = round(%s)" % (quant, in_rast))
+        quantized.append(quant)
+    if quant_exprs:
+        grass.run_command(
+            "r.mapcalc", expression="; ".join(quant_exprs), quiet=True
+        )
+    NDVI_max, NDVI_min, NDVI_range, NDWI = quantized
+
+    # the landcover category tests are needed several times across the
+    # class selections; evaluate each of them once into a boolean CELL
+    # raster so the landcover raster itself is read by this single
+    # batched r.mapcalc only
+    lc_forest_bool = "lc_forest_bool_%s" % id
+    lc_low_veg_bool = "lc_low_veg_bool_%s" % id
+    lc_agr_bool = "lc_agr_bool_%s" % id
+    lc_exprs = []
+    for lc_bool, lc_cats in (
+        (lc_forest_bool, lc_forest_class),
+        (lc_low_veg_bool, lc_low_veg_class),
+        (lc_agr_bool, lc_agr_class),
+    ):
+        rm_rasters.append(lc_bool)
+        lc_exprs.append(
+            "%s = if(%s,1,0)" % (lc_bool, category_test(landcover, lc_cats))
         )
+    grass.run_command("r.mapcalc", expression="; ".join(lc_exprs), quiet=True)
 
     grass.message(_("\nSelecting forest pixels..."))
     # (LC = 82 | LC = 83) & (NDVI max > q1) & (size > 2ha)
-    grass.run_command(
-        "r.mask",
-        raster=landcover,
-        maskcats=lc_forest_class,
-        quiet=True,
+    # instead of swapping the MASK raster, restrict the NDVI raster to
+    # the forest landcover classes with a masked view; the percentile and
+    # the class selection both run on the view
+    ndvi_max_forest = "ndvi_max_forest_tmp_%s" % id
+    rm_rasters.append(ndvi_max_forest)
+    eq = "%s = if(%s,%s,null())" % (
+        ndvi_max_forest,
+        lc_forest_bool,
+        NDVI_max,
     )
-    forest_NDVImax_p5 = get_percentile(NDVI_max, 5)
+    run_mapcalc(eq)
+    forest_NDVImax_p5 = get_percentile(ndvi_max_forest, 5, region)
     forest_tr_tmp = "forest_tr_tmp_%s" % id
     rm_rasters.append(forest_tr_tmp)
     eq = "%s = if(%s>%f,%s,null() )" % (
         forest_tr_tmp,
-        NDVI_max,
+        ndvi_max_forest,
         forest_NDVImax_p5,
         forest_class,
     )
-    grass.run_command("r.mapcalc", expression=eq, quiet=True)
+    run_mapcalc(eq)
     forest_tr = "forest_tr_%s" % id
     rm_rasters.append(forest_tr)
     tr_maps.append(forest_tr)
-    grass.run_command(
-        "r.reclass.area",
-        input=forest_tr_tmp,
-        output=forest_tr,
-        mode="greater",
-        value=1,
-        quiet=True,
-    )
-    grass.run_command("r.mask", flags="r")
+    filter_small_areas(forest_tr_tmp, forest_tr, 1, forest_class, region)
 
     grass.message(_("\nSelecting low vegetation pixels..."))
     # (LC = 102) & (NDVI min > 25%quantil)  &(size > 1ha)
-    grass.run_command(
-        "r.mask",
-        raster=landcover,
-        maskcats=lc_low_veg_class,
-        quiet=True,
+    ndvi_min_low_veg = "ndvi_min_low_veg_tmp_%s" % id
+    rm_rasters.append(ndvi_min_low_veg)
+    eq = "%s = if(%s,%s,null())" % (
+        ndvi_min_low_veg,
+        lc_low_veg_bool,
+        NDVI_min,
     )
-    low_veg_NDVImin_q1 = get_percentile(NDVI_min, 25)
+    run_mapcalc(eq)
+    low_veg_NDVImin_q1 = get_percentile(ndvi_min_low_veg, 25, region)
     low_veg_tr_tmp = "low_veg_tr_tmp_%s" % id
     rm_rasters.append(low_veg_tr_tmp)
     eq = "%s = if(%s>=%f,%s,null() )" % (
         low_veg_tr_tmp,
-        NDVI_min,
+        ndvi_min_low_veg,
         low_veg_NDVImin_q1,
         low_veg_class,
     )
-    grass.run_command("r.mapcalc", expression=eq, quiet=True)
+    run_mapcalc(eq)
     low_veg_tr = "low_veg_tr_%s" % id
     tr_maps.append(low_veg_tr)
     rm_rasters.append(low_veg_tr)
-    grass.run_command(
-        "r.reclass.area",
-        input=low_veg_tr_tmp,
-        output=low_veg_tr,
-        mode="greater",
-        value=1,
-        quiet=True,
+    filter_small_areas(low_veg_tr_tmp, low_veg_tr, 1, low_veg_class, region)
+
+    grass.message(_("\nComputing OSM distance rasters..."))
+    # the buffer tests downstream only ever ask "within radius R or
+    # not", so one continuous r.grow.distance pass per source replaces
+    # the per-radius r.buffer runs (roads was buffered at 10 m and
+    # 100 m, buildings at 50 m and 100 m) and the tests become plain
+    # threshold comparisons
+    roads_dist = "roads_dist_tmp_%s" % id
+    buildings_dist = "buildings_dist_tmp_%s" % id
+    water_dist = "water_dist_tmp_%s" % id
+    imp_dist = "imp_dist_tmp_%s" % id
+    dist_jobs = [
+        (roads, roads_dist),
+        (buildings, buildings_dist),
+        (map_water, water_dist),
+        (imperviousness, imp_dist),
+    ]
+    queue = ParallelModuleQueue(
+        nprocs=min(len(dist_jobs), os.cpu_count() or 1)
     )
-    grass.run_command("r.mask", flags="r")
+    for dist_input, dist_output in dist_jobs:
+        rm_rasters.append(dist_output)
+        queue.put(
+            Module(
+                "r.grow.distance",
+                input=dist_input,
+                distance=dist_output,
+                quiet=True,
+                run_=False,
+            )
+        )
+    queue.wait()
 
     grass.message(_("\nSelecting water pixels..."))
     # (NDWI > 1. quartil) & (ASM > median) & (LC =162) & (size > 1ha)
     # (besseres Ergebnis für NRW)
 
-    roads_buf10 = "roads_buf10_tmp_%s" % id
-    rm_rasters.append(roads_buf10)
     reflectance_thresh = 500
-    grass.run_command(
-        "r.buffer",
-        input=roads,
-        output=roads_buf10,
-        distances=10,
-        units="meters",
-        quiet=True,
-    )
-    grass.run_command("r.mask", raster=map_water, quiet=True)
-    # compute a "bright" raster
-    bright_rast = "brightness_%s" % os.getpid()
-    rm_rasters.append(bright_rast)
-    bright_expression = "%(out)s = if(%(red)s>%(thresh)f && \
-                        %(green)s>%(thresh)f && %(blue)s>%(thresh)f, \
-                        1,null())" % {
-        "out": bright_rast,
-        "red": red,
-        "green": green,
-        "blue": blue,
-        "thresh": reflectance_thresh,
-    }
-    grass.run_command("r.mapcalc", expression=bright_expression, quiet=True)
     # water_NDWI_median = get_percentile(NDWI, 50)
     water_tr = "water_tr_%s" % id
 
-    eq = "%s = if(%s>%f && isnull(%s) && isnull(%s),%s,null() )" % (
-        water_tr,
-        NDWI,
-        130,
-        roads_buf10,
-        bright_rast,
-        water_class,
+    # the OSM water condition is inlined instead of set as MASK; the
+    # former "bright" helper raster only served an isnull() test, so its
+    # condition is folded in directly via De Morgan
+    eq = (
+        "%s = if(not(isnull(%s)) && %s>%f && %s>10 && "
+        "!(%s>%f && %s>%f && %s>%f),%s,null() )"
+        % (
+            water_tr,
+            map_water,
+            NDWI,
+            130,
+            roads_dist,
+            red,
+            reflectance_thresh,
+            green,
+            reflectance_thresh,
+            blue,
+            reflectance_thresh,
+            water_class,
+        )
     )
-    grass.run_command("r.mapcalc", expression=eq, quiet=True)
+    run_mapcalc(eq)
     tr_maps.append(water_tr)
     rm_rasters.append(water_tr)
-    grass.run_command("r.mask", flags="r")
 
     grass.message(_("\nSelecting builtup pixels..."))
-    buildings_buf100 = "buildings_buf100_tmp_%s" % id
-    rm_rasters.append(buildings_buf100)
-    grass.run_command(
-        "r.buffer",
-        input=buildings,
-        output=buildings_buf100,
-        distances=100,
-        units="meters",
-        quiet=True,
-    )
-    roads_buf100 = "roads_buf100_tmp_%s" % id
-    rm_rasters.append(roads_buf100)
-    grass.run_command(
-        "r.buffer",
-        input=roads,
-        output=roads_buf100,
-        distances=100,
-        units="meters",
-        quiet=True,
-    )
     # (LC=62) & (Imperviousness > 50) & (NDBI > median)
     # grass.run_command("r.mask", raster=imperviousness, quiet=True)
 
-    map_water_buff = "water_buf_tmp_%s" % id
-    rm_rasters.append(map_water_buff)
-    grass.run_command(
-        "r.buffer",
-        input=map_water,
-        output=map_water_buff,
-        distances=50,
-        units="meters",
-        quiet=True,
-    )
     # imp_NDVI_q1 = get_percentile(NDVI_max, 25)
     builtup_tr = "builtup_tr_%s" % id
     tr_maps.append(builtup_tr)
@@ -377,212 +477,165 @@ def main():
     # eq = "%s = if(%s<=%f && isnull(%s) && %s!=%s && (%s>0 || %s>0),%s,null() )" % (
     #      builtup_tr, NDVI_max, 200, map_water_buff, landcover, lc_agr_class,
     #      buildings_buf100, roads_buf100, builtup_class)
-    # grass.run_command("r.mapcalc", expression=eq, quiet=True)
-    grass.run_command("r.mask", raster=coastline, quiet=True)
-
-    eq = f"{builtup_tr} = if({NDVI_max}<={200} && isnull({map_water_buff}) " \
-        f"&& {landcover}!={lc_agr_class.split(' ')[0]} && " \
-        f"{landcover}!={lc_agr_class.split(' ')[1]} && " \
-        f"({buildings_buf100}>0 ||| {roads_buf10}>0) &&& " \
-        f"{elevation} < 1000,{builtup_class},null() )"
-    grass.run_command("r.mapcalc", expression=eq, quiet=True)
-
-    # classify mixed urban pixels
+    # run_mapcalc(eq)
+
+    # the coastline condition is inlined instead of set as MASK; the
+    # cheap integer tests that reject most cells come first so the
+    # short-circuiting && skips the rest, and since a false and a null
+    # condition both end in null() here, the null-propagating operator
+    # variants are not needed
+    eq = f"{builtup_tr} = if({elevation}<1000 && {water_dist}>50 && " \
+        f"{lc_agr_bool}==0 && {NDVI_max}<={200} && " \
+        f"({buildings_dist}<=100 || {roads_dist}<=10) && " \
+        f"not(isnull({coastline})),{builtup_class},null() )"
+
+    # classify mixed urban pixels; under the otherwise identical
+    # predicates, "not already builtup" reduces to NDVI_max > 200, which
+    # keeps the two statements independent of each other
     builtup2_tr = "builtup2_tr_%s" % id
     tr_maps.append(builtup2_tr)
-    eq2 = f"{builtup2_tr} = if(isnull({builtup_tr}) && " \
-        f"{NDVI_max}<={220} && isnull({map_water_buff}) && " \
-        f"{landcover}!={lc_agr_class.split(' ')[0]} && " \
-        f"{landcover}!={lc_agr_class.split(' ')[1]} && " \
-        f"({buildings_buf100}>0 ||| {roads_buf10}>0) &&& " \
-        f"{elevation} < 1000,{builtup2_class},null() )"
-    grass.run_command("r.mapcalc", expression=eq2, quiet=True)
-    # grass.run_command("r.mask", flags="r")
-    grass.run_command("r.mask", flags="r", quiet=True)
-
-    grass.message(_("\nSelecting bare soil pixels..."))
-    grass.run_command("r.mask", raster=coastline, quiet=True)
-    buildings_buf50 = "buildings_buf50_tmp_%s" % id
-    rm_rasters.append(buildings_buf50)
+    eq2 = f"{builtup2_tr} = if({elevation}<1000 && {NDVI_max}>{200} && " \
+        f"{water_dist}>50 && " \
+        f"{lc_agr_bool}==0 && {NDVI_max}<={220} && " \
+        f"({buildings_dist}<=100 || {roads_dist}<=10) && " \
+        f"not(isnull({coastline})),{builtup2_class},null() )"
+    # both expressions share their inputs and are independent, so batch
+    # them into one parallel r.mapcalc call that reads each input only
+    # once; with six inputs per cell the row-strip parallelism pays off
     grass.run_command(
-        "r.buffer",
-        input=buildings,
-        output=buildings_buf50,
-        distances=50,
-        units="meters",
-        quiet=True,
+        "r.mapcalc", expression=f"{eq}; {eq2}", nprocs=NPROCS, quiet=True
     )
-    imp_buf = "imp_buf_tmp_%s" % id
-    rm_rasters.append(imp_buf)
-    grass.run_command("g.region", flags="ap", res=100)
-    grass.run_command(
-        "r.buffer",
-        input=imperviousness,
-        output=imp_buf,
-        distances=100,
-        units="meters",
-        quiet=True,
-    )
-    grass.run_command("g.region", region=oldregion)
+
+    grass.message(_("\nSelecting bare soil pixels..."))
     baresoil_tr_tmp = "baresoil_tr_tmp_%s" % id
     rm_rasters.append(baresoil_tr_tmp)
-    eq = f"{baresoil_tr_tmp}=if(isnull({buildings_buf50})&&" \
-        f"isnull({roads_buf10})&&isnull({imp_buf})&&" \
+    eq = f"{baresoil_tr_tmp}=if(not(isnull({coastline}))&&" \
+        f"{buildings_dist}>50&&" \
+        f"{roads_dist}>10&&{imp_dist}>100&&" \
         f"{NDVI_range}<=50&&{NDVI_max}<=200&&isnull({map_water})," \
         f"{baresoil_class},null())"
-    grass.run_command("r.mapcalc", expression=eq, quiet=True)
+    run_mapcalc(eq)
     baresoil_tr = "baresoil_tr_%s" % id
     tr_maps.append(baresoil_tr)
     rm_rasters.append(baresoil_tr)
-    grass.run_command(
-        "r.reclass.area",
-        input=baresoil_tr_tmp,
-        output=baresoil_tr,
-        mode="greater",
-        value=0.5,
-        quiet=True,
-    )
-    grass.run_command("r.mask", flags="r", quiet=True)
+    filter_small_areas(baresoil_tr_tmp, baresoil_tr, 0.5, baresoil_class, region)
 
     grass.message(_("\nSelecting agriculture pixels..."))
     # (NDVI range > 1.quartil) & (LC = 73) & (size > 2ha)
-    grass.run_command(
-        "r.mask",
-        raster=landcover,
-        maskcats=lc_agr_class,
-        quiet=True,
+    ndvi_range_agr = "ndvi_range_agr_tmp_%s" % id
+    rm_rasters.append(ndvi_range_agr)
+    eq = "%s = if(%s,%s,null())" % (
+        ndvi_range_agr,
+        lc_agr_bool,
+        NDVI_range,
     )
-    agr_NDVIrange_q1 = get_percentile(NDVI_range, 25)
+    run_mapcalc(eq)
+    agr_NDVIrange_q1 = get_percentile(ndvi_range_agr, 25, region)
     agr_tr_tmp = "agr_tr_tmp_%s" % id
     rm_rasters.append(agr_tr_tmp)
-    eq = "%s = if(%s>=%f&&isnull(%s)&&isnull(%s),%s,null() )" % (
+    eq = "%s = if(%s>=%f&&%s>50&&%s>10,%s,null() )" % (
         agr_tr_tmp,
-        NDVI_range,
+        ndvi_range_agr,
         agr_NDVIrange_q1,
-        buildings_buf50,
-        roads_buf10,
+        buildings_dist,
+        roads_dist,
         agr_class,
     )
-    grass.run_command("r.mapcalc", expression=eq, quiet=True)
+    run_mapcalc(eq)
     agr_tr = "agr_tr_%s" % id
     tr_maps.append(agr_tr)
     rm_rasters.append(agr_tr)
-    grass.run_command(
-        "r.reclass.area",
-        input=agr_tr_tmp,
-        output=agr_tr,
-        mode="greater",
-        value=2,
-        quiet=True,
-    )
-    grass.run_command("r.mask", flags="r")
+    filter_small_areas(agr_tr_tmp, agr_tr, 2, agr_class, region)
 
     grass.message(_("\nMerging training data pixels..."))
-    # sum all training maps
-    eq = "tr_sum_" + id + " = "
-    for rast in tr_maps:
-        eq += "if( isnull(" + rast + "), 0, 1 ) +"
-    grass.run_command("r.mapcalc", expression=eq[:-2], quiet=True)
-    rm_rasters.append("tr_sum_" + id)
-
-    # create mask where the pixel belong only to one class
+    training_patched = output
+    # encode the membership of each training map as one bit and OR them
+    # together; "belongs to exactly one class" is then the integer
+    # power-of-two test bits & (bits - 1) == 0 and the class code
+    # follows directly from the bit pattern, so the whole merge is a
+    # single integer expression without touching the map values again
+    tr_classes = {
+        forest_tr: forest_class,
+        low_veg_tr: low_veg_class,
+        water_tr: water_class,
+        builtup_tr: builtup_class,
+        builtup2_tr: builtup2_class,
+        baresoil_tr: baresoil_class,
+        agr_tr: agr_class,
+    }
+    bits_expr = " | ".join(
+        "((!isnull(%s)) << %d)" % (rast, k) for k, rast in enumerate(tr_maps)
+    )
+    patched = "null()"
+    for k, rast in reversed(list(enumerate(tr_maps))):
+        patched = "if(bits == %d,%s,%s)" % (1 << k, tr_classes[rast], patched)
     grass.run_command(
         "r.mapcalc",
-        expression=f"tr_mask{id} = if( tr_sum_{id} == 1, 1, null() )",
+        expression="%s = eval(bits = %s, if(bits & (bits - 1), null(), %s))"
+        % (training_patched, bits_expr, patched),
+        nprocs=NPROCS,
         quiet=True,
     )
-    rm_rasters.append("tr_mask" + id)
-    grass.run_command("r.mask", raster="tr_mask" + id, quiet=True)
+    rm_rasters.extend(tr_maps)
 
-    # testif there are pixels inside the training classes
+    # testif there are pixels inside the training classes; one r.stats
+    # pass over the patched raster counts all classes at once, and it
+    # counts the pixels actually available for sampling
+    class_counts = {}
+    for line in grass.read_command(
+        "r.stats", input=training_patched, flags="cn", separator=":"
+    ).splitlines():
+        cat, count = line.split(":")
+        class_counts[cat] = int(count)
     for rast in tr_maps:
-        r_univar = grass.parse_command("r.univar", map=rast, flags="g")
-        if int(r_univar["n"]) < int(npoints):
+        count = class_counts.get(tr_classes[rast], 0)
+        if count < int(npoints):
             grass.warning(
-                _("For <%s> only %s pixels found.") % (rast, r_univar["n"])
+                _("For <%s> only %s pixels found.") % (rast, count)
             )
-
-    training_patched = output
-    temp_output_column = output.lower()
-    # rm_rasters.append(training_patched)
-    grass.run_command("r.patch", input=tr_maps, output=training_patched)
-    grass.run_command("r.mask", flags="r")
-    rm_rasters.extend(tr_maps)
-    grass.run_command(
-        "r.sample.category",
-        input=training_patched,
+    grass.message(_("\nSampling training points..."))
+    # stratified sampling in NumPy: the patched raster is scanned once
+    # and npoints cells are drawn per class without replacement, instead
+    # of running the r.sample.category addon with its per-class scans;
+    # the picked cell centers go straight into v.in.ascii
+    class_names = {
+        forest_class: forest_name,
+        low_veg_class: low_veg_name,
+        water_class: water_name,
+        builtup_class: builtup_name,
+        builtup2_class: builtup2_name,
+        baresoil_class: baresoil_name,
+        agr_class: agr_name,
+    }
+    patched_arr = garray.array(training_patched, dtype=np.int32)
+    flat = patched_arr.ravel()
+    cols = patched_arr.shape[1]
+    rng = np.random.default_rng()
+    points = []
+    for rast in tr_maps:
+        cls = int(tr_classes[rast])
+        idx = np.flatnonzero(flat == cls)
+        pick = rng.choice(idx, min(int(npoints), idx.size), replace=False)
+        for cell in pick:
+            row, col = divmod(int(cell), cols)
+            east = region["w"] + (col + 0.5) * region["ewres"]
+            north = region["n"] - (row + 0.5) * region["nsres"]
+            points.append(
+                "%f|%f|%d|%s"
+                % (east, north, cls, class_names[tr_classes[rast]])
+            )
+    grass.write_command(
+        "v.in.ascii",
+        input="-",
+        stdin="\n".join(points),
         output=output,
-        npoints=npoints,
-    )
-    grass.run_command(
-        "v.db.renamecolumn",
-        map=output,
-        column="%s,lulc_class_int" % temp_output_column
-    )
-
-    grass.run_command(
-        "v.db.addcolumn",
-        map=output,
-        columns="lulc_class_str VARCHAR(25)"
-    )
-
-    grass.run_command(
-        "v.db.update",
-        map=output,
-        layer=1,
-        column="lulc_class_str",
-        where="lulc_class_int='%s'" % (forest_class),
-        value=forest_name,
-    )
-    grass.run_command(
-        "v.db.update",
-        map=output,
-        layer=1,
-        column="lulc_class_str",
-        where="lulc_class_int='%s'" % low_veg_class,
-        value=low_veg_name,
-    )
-    grass.run_command(
-        "v.db.update",
-        map=output,
-        layer=1,
-        column="lulc_class_str",
-        where="lulc_class_int='%s'" % water_class,
-        value=water_name,
-    )
-    grass.run_command(
-        "v.db.update",
-        map=output,
-        layer=1,
-        column="lulc_class_str",
-        where="lulc_class_int='%s'" % builtup_class,
-        value=builtup_name,
-    )
-    grass.run_command(
-        "v.db.update",
-        map=output,
-        layer=1,
-        column="lulc_class_str",
-        where="lulc_class_int='%s'" % baresoil_class,
-        value=baresoil_name,
-    )
-    grass.run_command(
-        "v.db.update",
-        map=output,
-        layer=1,
-        column="lulc_class_str",
-        where="lulc_class_int='%s'" % agr_class,
-        value=agr_name,
-    )
-
-    # mixed builtup pixels
-    grass.run_command(
-        "v.db.update",
-        map=output,
-        layer=1,
-        column="lulc_class_str",
-        where="lulc_class_int='%s'" % (builtup2_class),
-        value=builtup2_name,
+        x=1,
+        y=2,
+        columns=(
+            "x double precision, y double precision, "
+            "lulc_class_int integer, lulc_class_str varchar(25)"
+        ),
+        quiet=True,
     )
 
     grass.message(_("\nCreated output map <%s>" % (output)))